@@ -10,18 +10,31 @@
     The repository owner and name are taken from GITHUB_REPOSITORY.  The token
     is taken from INPUT_GITHUB_TOKEN."""
 import argparse
+import collections
+import concurrent.futures
+import copy
 import enum
+import hashlib
+import json
 import logging
 import os
 import re
 import sys
+import tempfile
 import rich.console
 import rich.logging
 import rich.progress
 import rich.table
+import orjson
 import requests
+import requests.adapters
 import yaml
 
+try:
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
+
 REPOSITORY_SETTINGS_FILE_PATH = os.path.join(
     os.environ.get("GITHUB_WORKSPACE", "."), ".repository-settings.yaml"
 )
@@ -29,116 +42,374 @@ DEFAULT_SETTINGS_FILE_PATH = os.path.join(
     os.environ.get("CONFIGDIR", "/etc/repository-settings"),
     "default-repository-settings.yaml",
 )
-SUBSTITUTION_REGEX = re.compile("<(?P<key>.*)>")
+RESPONSE_CACHE_DIRECTORY = os.path.join(
+    os.environ.get("GITHUB_WORKSPACE", "."), ".repo-settings-cache"
+)
+SUBSTITUTION_REGEX = re.compile("<(?P<key>[^<>]+)>")
+# Keep well under GitHub's secondary rate limit for concurrent requests
+MAX_CONCURRENT_REQUESTS = 16
+SETTINGS_CACHE_SIZE = 100
+COMPILED_SETTINGS_EXTENSION = ".json"
 
+_settings_cache = collections.OrderedDict()
+_console = rich.console.Console()
 
-def compare_values(value, reference_value, name=[]):
-    """Recursively compares value to reference_value, returning a dictionary
-    containing any mismatches."""
-    name = name if isinstance(name, list) else [name]
+
+def compare_values(value, reference_value, name: str = ""):
+    """Compares value to reference_value, returning a dictionary containing
+    any mismatches.  The structures are walked iteratively, accumulating
+    mismatches into a single result."""
     result = {}
-    if isinstance(reference_value, dict):
-        try:
-            for key, val in reference_value.items():
-                result = result | compare_values(value[key], val, [*name, key])
-        except Exception as ex:
-            logger.error(f"Unable to compare values for '{'.'.join(name)}': {ex}")
-            result[".".join(name)] = {"current": "UNKNOWN", "desired": reference_value}
-    elif isinstance(reference_value, list):
-        try:
-            # This approach performs a deep comparison of every element of the
-            # array.  To simply check presence in the array, use assert_in_array.
-            for index, val in enumerate(reference_value):
-                result = result | compare_values(value[index], val, [*name, str(index)])
-        except Exception as ex:
-            logger.error(f"Unable to compare list values: {ex}")
-            result[".".join(name)] = {"current": "UNKNOWN", "desired": ",".join(reference_value)}
-    elif reference_value != value:
-        result[".".join(name)] = {"current": value, "desired": reference_value}
+    stack = collections.deque([(value, reference_value, name)])
+    while stack:
+        value, reference_value, path = stack.pop()
+        if isinstance(reference_value, dict):
+            try:
+                for key, val in reference_value.items():
+                    stack.append(
+                        (value[key], val, f"{path}.{key}" if path else str(key))
+                    )
+            except Exception as ex:
+                logger.error(f"Unable to compare values for '{path}': {ex}")
+                result[path] = {
+                    "current": "UNKNOWN",
+                    "desired": reference_value,
+                }
+        elif isinstance(reference_value, list):
+            try:
+                # This approach performs a deep comparison of every element of
+                # the array.  To simply check presence in the array, use
+                # compare_array.
+                for index, val in enumerate(reference_value):
+                    stack.append(
+                        (value[index], val, f"{path}.{index}" if path else str(index))
+                    )
+            except Exception as ex:
+                logger.error(f"Unable to compare list values: {ex}")
+                result[path] = {
+                    "current": "UNKNOWN",
+                    "desired": ",".join(map(str, reference_value)),
+                }
+        elif reference_value != value:
+            result[path] = {"current": value, "desired": reference_value}
     return result
 
 
-def compare_array(gh_data: list, reference_values: list, key=None):
-    """Checks that gh_data contains each value in reference_values."""
+def _missing_values(values, reference_values: list) -> dict:
     errors = {}
-    values = [v[key] for v in gh_data] if key else [*gh_data]
     for index, val in enumerate(reference_values):
         if val not in values:
             errors[f"[{index}]"] = {"current": "None", "desired": val}
     return errors
 
 
-def substitute(value, substitutions: dict) -> dict:
-    """Performs deep substitution on value, replacing <foo.bar> with the
-    content of substitutions["foo"]["bar"]."""
-
-    def _deep_get(value: dict, key: str):
-        key_list = key.split(".")
-        val = dict(value)
-        while key_list:
-            k = key_list.pop(0)
-            val = val[k]
-        return val
-
-    def _lookup_substitution_value(substitution_value: str, substitutions: dict):
-        for key in [substitution_value, f"defaults.{substitution_value}"]:
-            try:
-                return _deep_get(substitutions, key)
-            except KeyError:
-                pass
-            except TypeError:
-                pass
+def compare_array(gh_data: list, reference_values: list, key=None):
+    """Checks that gh_data contains each value in reference_values."""
+    values = [v[key] for v in gh_data] if key else gh_data
+    try:
+        return _missing_values(set(values), reference_values)
+    except TypeError:
+        # Unhashable entries (e.g. objects without a key) need a linear search
+        return _missing_values(values, reference_values)
+
+
+def _index_substitutions(settings: dict) -> dict:
+    """Flattens settings into a dictionary keyed by dotted path (e.g.
+    "defaults.repo.default_branch") so substitutions resolve with a single
+    lookup."""
+    index = {}
+    stack = [(settings, "")]
+    while stack:
+        value, prefix = stack.pop()
+        for key, val in value.items():
+            if not isinstance(key, str):
+                continue
+            path = prefix + key
+            index[path] = val
+            if isinstance(val, dict):
+                stack.append((val, f"{path}."))
+    return index
+
+
+def _lookup_substitution_value(substitution_value: str, substitutions: dict):
+    for key in [substitution_value, f"defaults.{substitution_value}"]:
+        if key in substitutions:
+            return substitutions[key]
+
+    raise RuntimeError(f"Unable to find substitution for {substitution_value}")
+
+
+def _resolve_substitution(substitution_value: str, substitutions: dict, resolved):
+    """Returns the fully substituted value for <substitution_value>, memoized
+    in resolved since the same substitutions are typically used many times."""
+    if substitution_value not in resolved:
+        # Substituted values may themselves contain substitutions
+        resolved[substitution_value] = substitute(
+            _lookup_substitution_value(substitution_value, substitutions),
+            substitutions,
+            resolved=resolved,
+        )
+    return resolved[substitution_value]
 
-        raise RuntimeError(f"Unable to find substitution for {substitution_value}")
 
-    if isinstance(value, dict):
-        result = {}
-        for key, val in value.items():
-            key = substitute(key, substitutions)
-            result[key] = substitute(val, substitutions)
-        return result
-    elif isinstance(value, list):
-        return [substitute(val, substitutions) for val in value]
-    elif isinstance(value, str):
-        while True:
-            match = SUBSTITUTION_REGEX.search(value)
-            if match:
-                sub = _lookup_substitution_value(match.group("key"), substitutions)
-                value = value[: match.start()] + sub + value[match.end() :]
-            else:
-                break
-        return value
-    else:
+def _substitute_string(value, substitutions: dict, resolved: dict):
+    # Most strings contain no substitutions; skip the regex for those
+    if not isinstance(value, str) or "<" not in value:
         return value
 
+    return SUBSTITUTION_REGEX.sub(
+        lambda match: _resolve_substitution(
+            match.group("key"), substitutions, resolved
+        ),
+        value,
+    )
+
 
-def recursive_merge(dest: dict, source: dict):
-    """Non-destructively merges source into dest"""
-    for source_key, source_value in source.items():
-        if source_key not in dest:
-            dest[source_key] = source_value
-        elif isinstance(source_value, dict):
-            dest[source_key] = recursive_merge(dest[source_key], source_value)
+def substitute(value, substitutions: dict, defaults=None, resolved=None):
+    """Performs deep substitution on value, replacing <foo.bar> with the
+    content of substitutions["foo.bar"] (see _index_substitutions).
+
+    Any keys of defaults (already substituted) which are missing from value
+    are non-destructively merged in during the same pass.  Resolved
+    substitutions are memoized in resolved, which may be shared between calls
+    using the same substitutions."""
+    resolved = {} if resolved is None else resolved
+    result = [None]
+    queue = collections.deque([(value, defaults, result, 0)])
+    while queue:
+        value, defaults, parent, key = queue.popleft()
+        if isinstance(value, dict):
+            dest = parent[key] = {}
+            for source_key, source_value in value.items():
+                source_key = _substitute_string(source_key, substitutions, resolved)
+                default = (
+                    defaults.get(source_key) if isinstance(defaults, dict) else None
+                )
+                # Reserve the key now so the original key order is retained
+                dest[source_key] = None
+                queue.append((source_value, default, dest, source_key))
+            if isinstance(defaults, dict):
+                for default_key, default_value in defaults.items():
+                    if default_key not in dest:
+                        dest[default_key] = default_value
+        elif isinstance(value, list):
+            dest = parent[key] = [None] * len(value)
+            for index, val in enumerate(value):
+                queue.append((val, None, dest, index))
+        else:
+            parent[key] = _substitute_string(value, substitutions, resolved)
+
+    return result[0]
+
+
+def _settings_signature(stat: os.stat_result) -> str:
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+
+def _compile_settings(settings_file_path: str):
+    """Writes a JSON copy of a YAML settings file alongside it (JSON is much
+    quicker to parse).  The first line records the signature of the YAML
+    file so stale copies are detected without parsing them."""
+    stat = os.stat(settings_file_path)
+    with open(settings_file_path) as settings_file:
+        settings = yaml.load(settings_file, Loader=_Loader)
+
+    try:
+        content = json.dumps(settings)
+    except TypeError as ex:
+        raise RuntimeError(f"Unable to compile {settings_file_path}: {ex}") from ex
+    if json.loads(content) != settings:
+        raise RuntimeError(
+            f"Unable to compile {settings_file_path}: its content cannot be "
+            "represented exactly in JSON (e.g. non-string keys)"
+        )
+
+    compiled_file_path = settings_file_path + COMPILED_SETTINGS_EXTENSION
+    with tempfile.NamedTemporaryFile(
+        "w", dir=os.path.dirname(compiled_file_path), delete=False
+    ) as compiled_file:
+        compiled_file.write(_settings_signature(stat) + "\n")
+        compiled_file.write(content)
+    os.replace(compiled_file.name, compiled_file_path)
+
+    return compiled_file_path
+
+
+def _load_compiled_settings(settings_file_path: str, signature: str):
+    """Returns the settings written by _compile_settings, or None if they are
+    missing or were compiled from a different version of the YAML file."""
+    try:
+        with open(settings_file_path + COMPILED_SETTINGS_EXTENSION) as compiled_file:
+            if compiled_file.readline().rstrip("\n") != signature:
+                return None
+            return json.load(compiled_file)
+    except (OSError, ValueError):
+        return None
+
+
+def _cached_load(settings_file_path: str) -> dict:
+    """Parses a YAML settings file, re-using the previous result if the file
+    is unchanged (same mtime and size).  A deep copy is returned so callers
+    are free to modify the result."""
+    stat = os.stat(settings_file_path)
+    key = (settings_file_path, stat.st_mtime, stat.st_size)
+    if key in _settings_cache:
+        _settings_cache.move_to_end(key)
+        return copy.deepcopy(_settings_cache[key])
+
+    settings = _load_compiled_settings(settings_file_path, _settings_signature(stat))
+    if settings is None:
+        with open(settings_file_path) as settings_file:
+            settings = yaml.load(settings_file, Loader=_Loader)
+
+    _settings_cache[key] = settings
+    if len(_settings_cache) > SETTINGS_CACHE_SIZE:
+        _settings_cache.popitem(last=False)
+    return copy.deepcopy(settings)
+
+
+def _project_settings_cache_path():
+    """Returns the path at which the merged project settings are cached,
+    keyed by the content of both settings files and of this script (which
+    determines how they are merged).  Returns None, disabling the cache,
+    outside of a GitHub runner."""
+    if "RUNNER_TEMP" not in os.environ:
+        return None
+
+    digest = hashlib.sha256()
+    for settings_file_path in [
+        __file__,
+        REPOSITORY_SETTINGS_FILE_PATH,
+        DEFAULT_SETTINGS_FILE_PATH,
+    ]:
+        try:
+            with open(settings_file_path, "rb") as settings_file:
+                digest.update(settings_file.read())
+        except OSError:
+            pass
+        digest.update(b"\0")
 
-    return dest
+    return os.path.join(
+        os.environ["RUNNER_TEMP"], f"repository-settings-{digest.hexdigest()}.json"
+    )
 
 
 def _load_project_settings():
+    cache_path = _project_settings_cache_path()
+    if cache_path is None:
+        return _merge_project_settings()
+
+    try:
+        with open(cache_path, "rb") as cache_file:
+            project_settings = orjson.loads(cache_file.read())
+            logger.debug(f"Using cached settings from {cache_path}")
+            return project_settings
+    except (OSError, orjson.JSONDecodeError):
+        pass
+
+    project_settings = _merge_project_settings()
+
+    try:
+        content = orjson.dumps(project_settings)
+        # Only cache settings which are unchanged by the round trip through
+        # JSON (e.g. no dates or non-string keys)
+        if orjson.loads(content) == project_settings:
+            with tempfile.NamedTemporaryFile(
+                dir=os.path.dirname(cache_path), delete=False
+            ) as cache_file:
+                cache_file.write(content)
+            os.replace(cache_file.name, cache_path)
+    except (OSError, orjson.JSONEncodeError) as ex:
+        logger.debug(f"Unable to cache settings: {ex}")
+
+    return project_settings
+
+
+def _merge_project_settings():
     project_settings = {}
     for settings_file_path in [
         REPOSITORY_SETTINGS_FILE_PATH,
         DEFAULT_SETTINGS_FILE_PATH,
     ]:
         try:
-            with open(settings_file_path) as settings_file:
-                logger.debug(f"Using settings from {settings_file_path}")
-                project_settings = project_settings | yaml.safe_load(settings_file)
+            settings = _cached_load(settings_file_path)
+            logger.debug(f"Using settings from {settings_file_path}")
+            project_settings.update(settings)
         except OSError:
             pass
 
-    project_settings = substitute(project_settings, dict(project_settings))
+    substitutions = _index_substitutions(project_settings)
+    resolved = {}
+    if "defaults" not in project_settings:
+        return substitute(project_settings, substitutions, resolved=resolved)
+
+    defaults = substitute(
+        project_settings.pop("defaults"), substitutions, resolved=resolved
+    )
+    project_settings = substitute(project_settings, substitutions, defaults, resolved)
+    project_settings["defaults"] = defaults
+    return project_settings
+
+
+def _chown_to_workspace_owner(path: str):
+    """Gives path to the owner of the workspace.  The action runs as root,
+    but the runner must be able to clean the workspace for later jobs."""
+    workspace_stat = os.stat(os.path.dirname(RESPONSE_CACHE_DIRECTORY))
+    os.chown(path, workspace_stat.st_uid, workspace_stat.st_gid)
+
+
+def _make_response_cache_directory():
+    """Creates the response cache directory within the workspace, ignoring
+    its content so cached responses are never committed to the repository."""
+    os.makedirs(RESPONSE_CACHE_DIRECTORY, exist_ok=True)
+    _chown_to_workspace_owner(RESPONSE_CACHE_DIRECTORY)
+    gitignore_path = os.path.join(RESPONSE_CACHE_DIRECTORY, ".gitignore")
+    if not os.path.exists(gitignore_path):
+        with open(gitignore_path, "w") as gitignore_file:
+            gitignore_file.write("*\n")
+        _chown_to_workspace_owner(gitignore_path)
+
+
+def _get_resource(session: requests.Session, url: str) -> bytes:
+    """Returns the content of url.  A previously retrieved response is
+    revalidated using its ETag and, if unchanged (304 Not Modified), the
+    cached content is returned instead."""
+    cache_path = os.path.join(
+        RESPONSE_CACHE_DIRECTORY, hashlib.sha256(url.encode()).hexdigest()
+    )
+    headers = {}
+    cached_content = None
+    try:
+        with open(cache_path, "rb") as cache_file:
+            headers["If-None-Match"] = cache_file.readline().rstrip(b"\n").decode()
+            cached_content = cache_file.read()
+    except OSError:
+        pass
+
+    response = session.get(url, headers=headers)
+    if (
+        response.status_code == requests.codes.not_modified
+        and cached_content is not None
+    ):
+        logger.debug(f"Using cached response for {url}")
+        return cached_content
+
+    response.raise_for_status()
+
+    etag = response.headers.get("ETag")
+    if etag:
+        try:
+            _make_response_cache_directory()
+            with tempfile.NamedTemporaryFile(
+                dir=RESPONSE_CACHE_DIRECTORY, delete=False
+            ) as cache_file:
+                cache_file.write(etag.encode() + b"\n" + response.content)
+            os.replace(cache_file.name, cache_path)
+            _chown_to_workspace_owner(cache_path)
+        except OSError as ex:
+            logger.debug(f"Unable to cache response for {url}: {ex}")
 
-    return recursive_merge(project_settings, project_settings.get("defaults", {}))
+    return response.content
 
 
 class ResultType(str, enum.Enum):
@@ -159,6 +430,10 @@ class ResultsTable:
         ResultType.SUCCESS: "green",
         ResultType.IGNORED: "dim",
     }
+    RESULT_MARKUP = {
+        result_type: (f"[{color}]", f"[/{color}]")
+        for result_type, color in RESULTS_COLOR.items()
+    }
 
     def __init__(self) -> None:
         self.table = rich.table.Table(show_header=True)
@@ -187,11 +462,17 @@ class ResultsTable:
         return self.results[ResultType.ERROR]
 
     def add_results(
-        self, test_name: str, test_spec: dict, result_type: ResultType, mismatches={}
+        self,
+        test_name: str,
+        test_spec: dict,
+        result_type: ResultType,
+        mismatches: dict = None,
     ):
         """Adds the result of a single test assertion."""
-        color = ResultsTable.RESULTS_COLOR[result_type]
-        self.table.add_row(test_name, f"[{color}]{result_type.name}[/{color}]")
+        if mismatches is None:
+            mismatches = {}
+        open_markup, close_markup = ResultsTable.RESULT_MARKUP[result_type]
+        self.table.add_row(test_name, f"{open_markup}{result_type.name}{close_markup}")
         self.results[result_type] = self.results[result_type] + 1
         if result_type == ResultType.FAILED or result_type == ResultType.ERROR:
             for k in sorted(mismatches.keys()):
@@ -206,13 +487,17 @@ class ResultsTable:
 
     def print(self):
         """Print the results table to the console"""
-        console = rich.console.Console()
-        console.print(self.table)
+        _console.print(self.table)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Verify repository settings.")
     parser.add_argument("-v", "--verbose", action="store_true")
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="Pre-compile the default settings to JSON and exit",
+    )
 
     args = parser.parse_args()
 
@@ -230,6 +515,10 @@ if __name__ == "__main__":
 
     logger = logging.getLogger(os.path.basename(sys.argv[0]))
 
+    if args.compile:
+        logger.info(f"Compiled {_compile_settings(DEFAULT_SETTINGS_FILE_PATH)}")
+        sys.exit(0)
+
     project_settings = _load_project_settings()
 
     if not project_settings:
@@ -248,43 +537,78 @@ if __name__ == "__main__":
         logger.error(f"(Start by ensuring that this repository is public)")
         sys.exit(-1)
 
-    output = ResultsTable()
-    for test_name, test_spec in rich.progress.track(
-        project_settings.get("tests", {}).items(),
-        description=f"Validating settings for repository '{repo_name}'...",
-    ):
-        test_name = test_name.format(owner=owner_name, repo=repo_name)
-
-        if test_spec.get("ignore", False):
-            output.add_results(test_name, test_spec, ResultType.IGNORED)
-            continue
+    session = requests.Session()
+    session.headers["Authorization"] = f"Bearer {github_token}"
+    session.mount(
+        "https://",
+        requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=MAX_CONCURRENT_REQUESTS
+        ),
+    )
 
-        resource_path = test_spec["path"].format(owner=owner_name, repo=repo_name)
-        resource_path = "https://api.github.com/" + resource_path
-        logger.debug(f"Querying {resource_path}")
-        try:
-            result = requests.get(
-                resource_path,
-                headers={"Authorization": f"Bearer {github_token}"},
-            )
-            result.raise_for_status()
-            mismatches = {}
-            if "json" in test_spec:
-                mismatches = compare_values(result.json(), test_spec["json"])
-            elif "array" in test_spec:
-                mismatches = compare_array(
-                    result.json(), test_spec["array"], key=test_spec.get("key")
+    # Issue every query up front; the API round trips dominate the runtime so
+    # they are performed concurrently over a single keep-alive connection pool.
+    pending = []
+    # Several tests may assert on the same resource; it is only queried once
+    queries = {}
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=MAX_CONCURRENT_REQUESTS
+    ) as executor:
+        for test_name, test_spec in project_settings.get("tests", {}).items():
+            test_name = test_name.format(owner=owner_name, repo=repo_name)
+            ignore = test_spec.get("ignore", False)
+            path = test_spec.get("path")
+
+            if ignore:
+                pending.append((test_name, test_spec, None))
+                continue
+
+            resource_path = path.format(owner=owner_name, repo=repo_name)
+            resource_path = "https://api.github.com/" + resource_path
+            if resource_path not in queries:
+                logger.debug(f"Querying {resource_path}")
+                queries[resource_path] = executor.submit(
+                    _get_resource, session, resource_path
+                )
+            pending.append((test_name, test_spec, queries[resource_path]))
+
+        # Results are collected in declaration order so the output table is
+        # stable from run to run.
+        output = ResultsTable()
+        description = f"Validating settings for repository '{repo_name}'..."
+        if sys.stdout.isatty():
+            pending = rich.progress.track(pending, description=description)
+        else:
+            # No need to render a live progress bar into a CI log
+            logger.info(f"{description} ({len(pending)} tests)")
+
+        for test_name, test_spec, future in pending:
+            if future is None:
+                output.add_results(test_name, test_spec, ResultType.IGNORED)
+                continue
+
+            json_spec = test_spec.get("json")
+            array_spec = test_spec.get("array")
+            array_key = test_spec.get("key")
+            try:
+                content = future.result()
+                mismatches = {}
+                if json_spec is not None:
+                    mismatches = compare_values(orjson.loads(content), json_spec)
+                elif array_spec is not None:
+                    mismatches = compare_array(
+                        orjson.loads(content), array_spec, key=array_key
+                    )
+
+                output.add_results(
+                    test_name,
+                    test_spec,
+                    ResultType.FAILED if mismatches else ResultType.SUCCESS,
+                    mismatches=mismatches,
                 )
 
-            output.add_results(
-                test_name,
-                test_spec,
-                ResultType.FAILED if mismatches else ResultType.SUCCESS,
-                mismatches=mismatches,
-            )
-
-        except requests.exceptions.HTTPError:
-            output.add_results(test_name, test_spec, ResultType.ERROR)
+            except requests.exceptions.HTTPError:
+                output.add_results(test_name, test_spec, ResultType.ERROR)
 
     output.print()
     sys.exit(
@@ -0,0 +1,279 @@
+import logging
+import os
+
+import pytest
+import requests
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def logger(monkeypatch):
+    # main.logger is normally created in __main__
+    monkeypatch.setattr(main, "logger", logging.getLogger("test"), raising=False)
+
+
+def test_compare_values_matching():
+    assert (
+        main.compare_values({"a": {"b": [1, "x"]}, "c": True}, {"a": {"b": [1, "x"]}})
+        == {}
+    )
+
+
+def test_compare_values_mismatch():
+    assert main.compare_values(
+        {"a": {"b": 1}, "c": [1, 2]}, {"a": {"b": 2}, "c": [1, 3]}
+    ) == {
+        "a.b": {"current": 1, "desired": 2},
+        "c.1": {"current": 2, "desired": 3},
+    }
+
+
+def test_compare_values_missing_key():
+    assert main.compare_values({"a": {}}, {"a": {"b": 1}}) == {
+        "a": {"current": "UNKNOWN", "desired": {"b": 1}}
+    }
+
+
+def test_compare_values_short_list_of_non_strings():
+    assert main.compare_values({"a": [1, 2]}, {"a": [1, 2, 3]}) == {
+        "a": {"current": "UNKNOWN", "desired": "1,2,3"}
+    }
+
+
+def test_compare_values_short_list_of_objects():
+    assert main.compare_values(
+        {"a": {"rules": []}}, {"a": {"rules": [{"p": "v*"}]}}
+    ) == {"a.rules": {"current": "UNKNOWN", "desired": "{'p': 'v*'}"}}
+
+
+class FakeSession:
+    """Returns canned responses, honouring If-None-Match"""
+
+    def __init__(self, content, etag):
+        self.content = content
+        self.etag = etag
+        self.requests = []
+
+    def get(self, url, headers=None):
+        self.requests.append(headers)
+        response = requests.Response()
+        response.url = url
+        if self.etag and headers.get("If-None-Match") == self.etag:
+            response.status_code = 304
+            response._content = b""
+        else:
+            response.status_code = 200
+            response._content = self.content
+            if self.etag:
+                response.headers["ETag"] = self.etag
+        return response
+
+
+@pytest.fixture
+def chowned(monkeypatch, tmp_path):
+    cache_directory = tmp_path / ".repo-settings-cache"
+    monkeypatch.setattr(main, "RESPONSE_CACHE_DIRECTORY", str(cache_directory))
+    chowned = {}
+    monkeypatch.setattr(
+        os, "chown", lambda path, uid, gid: chowned.__setitem__(path, (uid, gid))
+    )
+    return chowned
+
+
+def test_get_resource_caches_response_with_etag(chowned, tmp_path):
+    session = FakeSession(b'{"a": 1}', '"etag"')
+
+    assert main._get_resource(session, "https://api.github.com/x") == b'{"a": 1}'
+    assert session.requests == [{}]
+
+    cache_directory = tmp_path / ".repo-settings-cache"
+    cache_files = sorted(p.name for p in cache_directory.iterdir())
+    assert len(cache_files) == 2 and cache_files[0] == ".gitignore"
+    assert (cache_directory / ".gitignore").read_text() == "*\n"
+    assert (cache_directory / cache_files[1]).read_bytes() == b'"etag"\n{"a": 1}'
+
+    # Everything is handed to the owner of the workspace
+    workspace_stat = os.stat(tmp_path)
+    assert {
+        os.path.basename(p): owner for p, owner in chowned.items()
+    } == dict.fromkeys(
+        [".repo-settings-cache", *cache_files],
+        (workspace_stat.st_uid, workspace_stat.st_gid),
+    )
+
+
+def test_get_resource_reuses_cached_response_when_not_modified(chowned):
+    session = FakeSession(b'{"a": 1}', '"etag"')
+    main._get_resource(session, "https://api.github.com/x")
+    session.content = b"ignored"
+
+    assert main._get_resource(session, "https://api.github.com/x") == b'{"a": 1}'
+    assert session.requests == [{}, {"If-None-Match": '"etag"'}]
+
+
+def test_get_resource_without_etag_is_not_cached(chowned, tmp_path):
+    session = FakeSession(b"[]", None)
+
+    assert main._get_resource(session, "https://api.github.com/x") == b"[]"
+    assert not (tmp_path / ".repo-settings-cache").exists()
+
+
+@pytest.fixture
+def load_settings(monkeypatch, tmp_path):
+    """Merges the given repository and default settings (as YAML)"""
+
+    def _load_settings(repository_settings: str, default_settings: str):
+        repository_settings_path = tmp_path / ".repository-settings.yaml"
+        repository_settings_path.write_text(repository_settings)
+        default_settings_path = tmp_path / "default-repository-settings.yaml"
+        default_settings_path.write_text(default_settings)
+        monkeypatch.setattr(
+            main, "REPOSITORY_SETTINGS_FILE_PATH", str(repository_settings_path)
+        )
+        monkeypatch.setattr(
+            main, "DEFAULT_SETTINGS_FILE_PATH", str(default_settings_path)
+        )
+        return main._merge_project_settings()
+
+    return _load_settings
+
+
+DEFAULT_SETTINGS = """
+defaults:
+  repo:
+    default_branch: main
+    visibility: public
+  tests:
+    Ensure repository settings:
+      path: repos/{owner}/{repo}
+      json:
+        visibility: public
+        license:
+          key: gpl-3.0
+    Ensure '<repo.default_branch>' is protected:
+      path: repos/{owner}/{repo}/branches/<repo.default_branch>/protection
+"""
+
+
+def test_merge_project_settings_defaults(load_settings):
+    settings = load_settings("{}", DEFAULT_SETTINGS)
+
+    assert settings["repo"] == {"default_branch": "main", "visibility": "public"}
+    assert settings["tests"]["Ensure 'main' is protected"] == {
+        "path": "repos/{owner}/{repo}/branches/main/protection"
+    }
+    assert settings["defaults"]["tests"] == settings["tests"]
+
+
+def test_merge_project_settings_repository_overrides(load_settings):
+    settings = load_settings(
+        """
+repo:
+  default_branch: develop
+tests:
+  Ensure repository settings:
+    json:
+      license:
+        key: mit
+""",
+        DEFAULT_SETTINGS,
+    )
+
+    assert settings["repo"] == {"default_branch": "develop", "visibility": "public"}
+    assert settings["tests"] == {
+        "Ensure repository settings": {
+            "path": "repos/{owner}/{repo}",
+            "json": {"visibility": "public", "license": {"key": "mit"}},
+        },
+        "Ensure 'develop' is protected": {
+            "path": "repos/{owner}/{repo}/branches/develop/protection"
+        },
+    }
+
+
+def test_merge_project_settings_nested_substitution(load_settings):
+    settings = load_settings(
+        """
+name: <org>-<suffix>
+suffix: x
+""",
+        """
+defaults:
+  org: <owner.login>
+owner:
+  login: kll
+""",
+    )
+
+    assert settings["name"] == "kll-x"
+    assert settings["org"] == "kll"
+
+
+def test_merge_project_settings_unknown_substitution(load_settings):
+    with pytest.raises(RuntimeError, match="Unable to find substitution for nope"):
+        load_settings("name: <nope>\n", DEFAULT_SETTINGS)
+
+
+def test_merge_project_settings_default_dict_over_scalar(load_settings):
+    settings = load_settings(
+        "license: null\n", "defaults:\n  license:\n    key: gpl-3.0\n"
+    )
+
+    assert settings["license"] is None
+
+
+def test_merge_project_settings_lists_are_not_merged(load_settings):
+    settings = load_settings(
+        "rules:\n  - pattern: release/*\n",
+        "defaults:\n  rules:\n    - pattern: v*\n      enabled: true\n",
+    )
+
+    assert settings["rules"] == [{"pattern": "release/*"}]
+
+
+def test_merge_project_settings_retains_test_order(load_settings):
+    settings = load_settings(
+        """
+tests:
+  Zeta: {path: z}
+  Alpha: {path: a}
+""",
+        """
+defaults:
+  tests:
+    Mu: {path: m}
+    Beta: {path: b}
+    Zeta: {path: default}
+""",
+    )
+
+    assert list(settings["tests"]) == ["Zeta", "Alpha", "Mu", "Beta"]
+    assert settings["tests"]["Zeta"] == {"path": "z"}
+
+
+def test_substitute_several_tokens_in_one_string():
+    substitutions = main._index_substitutions({"a": "x", "defaults": {"b": "y"}})
+
+    assert main.substitute("<a>-<b> <a>", substitutions) == "x-y x"
+
+
+def test_compare_array_hashable():
+    assert main.compare_array(["v*", "release/*"], ["v*", "main", "release/*"]) == {
+        "[1]": {"current": "None", "desired": "main"}
+    }
+    assert main.compare_array([{"pattern": "v*"}], ["v*", "main"], key="pattern") == {
+        "[1]": {"current": "None", "desired": "main"}
+    }
+
+
+def test_compare_array_unhashable():
+    # Without a key, entries are compared as whole (unhashable) objects
+    assert main.compare_array(
+        [{"pattern": "v*"}, {"pattern": "x"}],
+        [{"pattern": "x"}, {"pattern": "main"}, {"pattern": "v*"}],
+    ) == {"[1]": {"current": "None", "desired": {"pattern": "main"}}}
+    # ... as are unhashable reference values against hashable entries
+    assert main.compare_array(["v*"], ["v*", {"pattern": "main"}]) == {
+        "[1]": {"current": "None", "desired": {"pattern": "main"}}
+    }